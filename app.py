@@ -1,13 +1,15 @@
 import streamlit as st
 from supabase import create_client, Client
-import random
+from postgrest.exceptions import APIError
 import time
 import io
 import uuid
-from PIL import Image, ImageDraw, ImageFont
 import pandas as pd
 from datetime import datetime
 import os
+import re
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Configuração Inicial ---
 st.set_page_config(
@@ -27,33 +29,229 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# --- SQL ---
+
+# Números de todas as reuniões em uma única tabela; cada reunião é identificada
+# pelo mesmo table_name registrado em meetings_metadata (e usado nos links).
+MEETING_NUMBERS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS public.meeting_numbers (
+    table_name TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    assigned BOOLEAN NOT NULL DEFAULT FALSE,
+    assigned_at TIMESTAMPTZ,
+    user_id TEXT,
+    PRIMARY KEY (table_name, number)
+);
+CREATE INDEX IF NOT EXISTS meeting_numbers_user_idx ON public.meeting_numbers (user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS meeting_numbers_meeting_user_uk ON public.meeting_numbers (table_name, user_id);
+CREATE INDEX IF NOT EXISTS meeting_numbers_free_idx ON public.meeting_numbers (table_name) WHERE assigned = FALSE;
+"""
+
+# Popula os números de uma reunião no próprio servidor.
+SEED_MEETING_NUMBERS_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION public.seed_meeting_numbers(tab TEXT, max_number INTEGER)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    INSERT INTO public.meeting_numbers (table_name, number)
+    SELECT tab, g FROM generate_series(1, max_number) g;
+$$;
+"""
+
+# Retorna o número do usuário na reunião, atribuindo atomicamente um número livre
+# se ele ainda não tiver um: uma só ida ao banco e sem corrida entre participantes
+# simultâneos (SKIP LOCKED + índice único por usuário).
+ASSIGN_NUMBER_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION public.assign_number(tab TEXT, uid TEXT)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    assigned_number INTEGER;
+BEGIN
+    SELECT number INTO assigned_number FROM public.meeting_numbers
+    WHERE table_name = tab AND user_id = uid;
+    IF FOUND THEN
+        RETURN assigned_number;
+    END IF;
+
+    UPDATE public.meeting_numbers
+    SET assigned = TRUE, assigned_at = now(), user_id = uid
+    WHERE table_name = tab
+      AND number = (SELECT number FROM public.meeting_numbers
+                    WHERE table_name = tab AND assigned = FALSE
+                    ORDER BY random() LIMIT 1 FOR UPDATE SKIP LOCKED)
+    RETURNING number INTO assigned_number;
+    RETURN assigned_number;
+EXCEPTION WHEN unique_violation THEN
+    -- Outra sessão do mesmo usuário atribuiu um número ao mesmo tempo
+    SELECT number INTO assigned_number FROM public.meeting_numbers
+    WHERE table_name = tab AND user_id = uid;
+    RETURN assigned_number;
+END;
+$$;
+"""
+
+# Remove uma reunião e seus números em uma única chamada.
+DELETE_MEETING_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION public.delete_meeting(tab TEXT)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    DELETE FROM public.meeting_numbers WHERE table_name = tab;
+    DELETE FROM public.meetings_metadata WHERE table_name = tab;
+$$;
+"""
+
+# Totais e atribuições por hora de uma reunião em uma única chamada,
+# agregados no servidor.
+MEETING_STATS_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION public.get_meeting_stats(tab TEXT)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT jsonb_build_object(
+        'total', (SELECT count(*) FROM public.meeting_numbers WHERE table_name = tab),
+        'assigned', (SELECT count(*) FROM public.meeting_numbers WHERE table_name = tab AND assigned),
+        'hourly', (
+            SELECT COALESCE(jsonb_agg(jsonb_build_object('hour', h.hour, 'count', h.count) ORDER BY h.hour), '[]'::jsonb)
+            FROM (
+                SELECT date_trunc('hour', assigned_at) AS hour, count(*) AS count
+                FROM public.meeting_numbers
+                WHERE table_name = tab AND assigned AND assigned_at IS NOT NULL
+                GROUP BY 1
+            ) h
+        )
+    );
+$$;
+"""
+
+# Copia para meeting_numbers as reuniões criadas quando cada uma tinha a sua
+# própria tabela (as tabelas antigas são mantidas intactas).
+LEGACY_MEETING_TABLES_MIGRATION_SQL = """
+DO $$
+DECLARE
+    m RECORD;
+BEGIN
+    FOR m IN
+        SELECT meta.table_name FROM public.meetings_metadata meta
+        WHERE to_regclass('public.' || quote_ident(meta.table_name)) IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM public.meeting_numbers n WHERE n.table_name = meta.table_name)
+    LOOP
+        EXECUTE format(
+            'INSERT INTO public.meeting_numbers (table_name, number, assigned, assigned_at, user_id)
+             SELECT %L, number, COALESCE(assigned, FALSE), assigned_at, user_id FROM public.%I
+             ON CONFLICT DO NOTHING',
+            m.table_name, m.table_name);
+    END LOOP;
+END;
+$$;
+"""
+
+# Índices das tabelas de formulários, que não são criadas pelo app: cada bloco
+# só roda se a tabela existir. A resposta única por pergunta e participante
+# impede envios duplicados; em bancos que já tenham duplicatas é apenas ignorada.
+FORMS_INDEXES_SQL = """
+DO $$
+BEGIN
+    IF to_regclass('public.responses') IS NOT NULL THEN
+        CREATE INDEX IF NOT EXISTS responses_participant_form_idx ON public.responses (participant_id, form_id);
+        BEGIN
+            CREATE UNIQUE INDEX IF NOT EXISTS responses_form_participant_question_uk
+                ON public.responses (form_id, participant_id, question_id);
+        EXCEPTION WHEN unique_violation THEN
+            RAISE NOTICE 'responses possui respostas duplicadas; índice único não criado';
+        END;
+    END IF;
+    IF to_regclass('public.questions') IS NOT NULL THEN
+        CREATE INDEX IF NOT EXISTS questions_form_idx ON public.questions (form_id);
+    END IF;
+    IF to_regclass('public.options') IS NOT NULL THEN
+        CREATE INDEX IF NOT EXISTS options_question_idx ON public.options (question_id);
+    END IF;
+END;
+$$;
+"""
+
+# Objetos de banco compartilhados pelo app (tabela de números, funções e índices
+# das consultas frequentes), criados uma vez por processo e na ordem listada.
+SCHEMA_STATEMENTS = (
+    MEETING_NUMBERS_TABLE_SQL,
+    SEED_MEETING_NUMBERS_FUNCTION_SQL,
+    ASSIGN_NUMBER_FUNCTION_SQL,
+    MEETING_STATS_FUNCTION_SQL,
+    DELETE_MEETING_FUNCTION_SQL,
+    LEGACY_MEETING_TABLES_MIGRATION_SQL,
+    FORMS_INDEXES_SQL,
+    "NOTIFY pgrst, 'reload schema';",
+)
+
 # --- Funções ---
 
-def get_supabase_client() -> Client:
-    """Estabelece conexão com o Supabase usando variáveis de ambiente."""
+@st.cache_resource
+def create_supabase_client() -> Client:
+    """Cria a conexão com o Supabase uma única vez por processo (falhas levantam exceção e não ficam no cache)."""
     supabase_url = os.getenv("SUPABASE_URL")
     supabase_key = os.getenv("SUPABASE_KEY")
     if not supabase_url or not supabase_key:
-        st.error("Credenciais do Supabase não configuradas no ambiente.")
-        return None
+        raise RuntimeError("Credenciais do Supabase não configuradas no ambiente.")
+    return create_client(supabase_url, supabase_key)
+
+def get_supabase_client() -> Client:
+    """Retorna a conexão compartilhada com o Supabase ou None (exibindo o erro)."""
     try:
-        client = create_client(supabase_url, supabase_key)
-        client.table("_dummy").select("*").limit(1).execute()
-        return client
+        return create_supabase_client()
+    except RuntimeError as e:
+        st.error(str(e))
+        return None
     except Exception as e:
         st.error(f"Erro ao conectar ao Supabase: {str(e)}")
         return None
 
-def check_table_exists(supabase, table_name):
-    """Verifica se uma tabela específica existe no Supabase."""
+SCHEMA_RETRY_SECONDS = 600
+
+@st.cache_resource
+def ensure_schema(_supabase):
+    """Cria/atualiza as tabelas e funções usadas pelo app uma única vez por processo (falhas levantam exceção e não ficam no cache)."""
+    # Todas as instruções em um único script: uma só chamada ao execute_sql
+    _supabase.rpc("execute_sql", {"query": "\n".join(SCHEMA_STATEMENTS)}).execute()
+    return True
+
+@st.cache_resource
+def get_schema_failure():
+    """Última falha de ensure_schema no processo, usada para espaçar as novas tentativas."""
+    return {"error": None, "at": 0.0}
+
+def prepare_schema(supabase):
+    """Garante o esquema; retorna a mensagem de erro ou None, tentando de novo no máximo a cada SCHEMA_RETRY_SECONDS."""
+    failure = get_schema_failure()
+    if failure["error"] and time.time() - failure["at"] < SCHEMA_RETRY_SECONDS:
+        return failure["error"]
     try:
-        supabase.table(table_name).select("*").limit(1).execute()
-        return True
+        ensure_schema(supabase)
+        failure["error"] = None
+        return None
+    except Exception as e:
+        failure["error"], failure["at"] = str(e), time.time()
+        return failure["error"]
+
+def build_table_name(prefix, name):
+    """Gera o identificador de uma reunião/formulário contendo apenas [a-z0-9_]."""
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    slug = re.sub(r"[^a-z0-9]+", "_", ascii_name.lower()).strip("_")[:40]
+    return f"{prefix}_{int(time.time())}_{slug}"
+
+def meeting_exists(supabase, table_name):
+    """Verifica se uma reunião está registrada em meetings_metadata."""
+    try:
+        response = supabase.table("meetings_metadata").select("table_name").eq("table_name", table_name).limit(1).execute()
+        return bool(response.data)
     except Exception:
         return False
 
-def create_meeting_table(supabase, table_name, meeting_name, max_number=999):
-    """Cria uma nova tabela para uma reunião no Supabase e registra metadados."""
+def create_meeting(supabase, table_name, meeting_name, max_number=999):
+    """Registra uma nova reunião e popula seus números em meeting_numbers."""
     try:
         response_metadata = supabase.table("meetings_metadata").insert({
             "table_name": table_name,
@@ -62,56 +260,51 @@ def create_meeting_table(supabase, table_name, meeting_name, max_number=999):
             "max_number": max_number
         }).execute()
 
-        create_table_query = f"""
-        CREATE TABLE public.{table_name} (
-            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
-            number INTEGER NOT NULL,
-            assigned BOOLEAN DEFAULT FALSE,
-            assigned_at TIMESTAMPTZ,
-            user_id TEXT
-        );
-        """
-        supabase.rpc("execute_sql", {"query": create_table_query}).execute()
-
-        time.sleep(1)
-        if not check_table_exists(supabase, table_name):
-            raise Exception(f"Tabela {table_name} não foi criada com sucesso no Supabase.")
-
-        batch_size = 100
-        for i in range(0, max_number, batch_size):
-            end = min(i + batch_size, max_number)
-            data = [{"number": j, "assigned": False, "assigned_at": None, "user_id": None} 
-                    for j in range(i+1, end+1)]
-            supabase.table(table_name).insert(data).execute()
-        
+        # Popula todos os números em uma única instrução no servidor (os defaults cobrem assigned/user_id)
+        supabase.rpc("seed_meeting_numbers", {"tab": table_name, "max_number": int(max_number)}).execute()
+
         return True
     except Exception as e:
-        st.error(f"Erro ao criar tabela de reunião: {str(e)}")
+        st.error(f"Erro ao criar reunião: {str(e)}")
         try:
-            supabase.table("meetings_metadata").delete().eq("table_name", table_name).execute()
-            supabase.rpc("execute_sql", {"query": f"DROP TABLE IF EXISTS public.{table_name}"}).execute()
+            supabase.rpc("delete_meeting", {"tab": table_name}).execute()
         except Exception as rollback_e:
             st.error(f"Erro no rollback: {str(rollback_e)}")
         return False
 
-def get_available_meetings(supabase):
+@st.cache_data(ttl=30)
+def get_available_meetings(_supabase):
     """Recupera a lista de reuniões disponíveis da tabela de metadados."""
     try:
-        response = supabase.table("meetings_metadata").select("*").execute()
+        response = _supabase.table("meetings_metadata").select("table_name, meeting_name, created_at, max_number").execute()
         return response.data if response.data else []
     except Exception as e:
         st.error(f"Erro ao recuperar reuniões: {str(e)}")
         return []
 
-def get_available_forms(supabase):
+@st.cache_data(ttl=300)
+def get_meeting_info(_supabase, table_name):
+    """Recupera os metadados de uma reunião (estáticos após a criação)."""
+    response = _supabase.table("meetings_metadata").select("table_name, meeting_name").eq("table_name", table_name).execute()
+    return response.data[0] if response.data else None
+
+@st.cache_data(ttl=30)
+def get_available_forms(_supabase):
     """Recupera a lista de formulários disponíveis da tabela de metadados."""
     try:
-        response = supabase.table("forms_metadata").select("*").execute()
+        response = _supabase.table("forms_metadata").select("id, form_name, table_name, created_at").execute()
         return response.data if response.data else []
     except Exception as e:
         st.error(f"Erro ao recuperar formulários: {str(e)}")
         return []
 
+@st.cache_data(ttl=300)
+def get_form_with_questions(_supabase, table_name):
+    """Recupera um formulário com suas perguntas e opções (estáticos após a criação)."""
+    # Formulário, perguntas e opções em uma única consulta (embedding do PostgREST)
+    response = _supabase.table("forms_metadata").select("id, form_name, questions(id, question_text, question_type, options(id, option_text))").eq("table_name", table_name).execute()
+    return response.data[0] if response.data else None
+
 def get_answered_forms(supabase, participant_id):
     """Recupera os IDs dos formulários já respondidos por um participant_id."""
     try:
@@ -121,36 +314,80 @@ def get_answered_forms(supabase, participant_id):
         st.error(f"Erro ao verificar formulários respondidos: {str(e)}")
         return set()
 
+def has_answered_form(supabase, participant_id, form_id):
+    """Verifica se um participant_id já respondeu um formulário específico."""
+    try:
+        response = supabase.table("responses").select("form_id", count="exact", head=True).eq("form_id", form_id).eq("participant_id", participant_id).execute()
+        return bool(response.count)
+    except Exception as e:
+        st.error(f"Erro ao verificar formulários respondidos: {str(e)}")
+        return False
+
+@st.cache_data(ttl=60)
+def build_meeting_csv(_supabase, table_name, revision):
+    """Gera o CSV dos números de uma reunião; revision (nº de atribuições) renova o cache."""
+    response = _supabase.table("meeting_numbers").select("*").eq("table_name", table_name).execute()
+    if not response.data:
+        return None
+    csv_buffer = io.BytesIO()
+    pd.DataFrame(response.data).to_csv(csv_buffer, index=False)
+    return csv_buffer.getvalue()
+
+@st.cache_resource
+def get_number_font():
+    """Carrega a fonte do número uma única vez (dígitos não precisam de shaping complexo)."""
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype("Arial.ttf", 200, layout_engine=ImageFont.Layout.BASIC)
+    except IOError:
+        return ImageFont.load_default()
+
+@st.cache_resource
+def get_digit_metrics():
+    """Pré-calcula a largura de cada dígito e a altura dos dígitos na fonte do número."""
+    font = get_number_font()
+    digit_widths = {digit: font.getlength(digit) for digit in "0123456789"}
+    bbox = font.getbbox("0")
+    return digit_widths, bbox[3] - bbox[1]
+
 def generate_number_image(number):
     """Gera uma imagem com o número atribuído."""
+    # PIL só é importado por quem gera a imagem, fora do caminho de inicialização
+    from PIL import Image, ImageDraw
+
     width, height = 600, 300
     img = Image.new("RGB", (width, height), color=(255, 255, 255))
     draw = ImageDraw.Draw(img)
     
+    # Gradiente desenhado linha a linha: a cor só varia com y
     for y in range(height):
         r = int(220 - y/3)
         g = int(240 - y/3)
         b = 255
-        for x in range(width):
-            draw.point((x, y), fill=(r, g, b))
+        draw.line([(0, y), (width - 1, y)], fill=(r, g, b))
     
-    try:
-        font = ImageFont.truetype("Arial.ttf", 200)
-    except IOError:
-        font = ImageFont.load_default()
+    font = get_number_font()
+    digit_widths, text_height = get_digit_metrics()
     
     number_text = str(number)
-    bbox = draw.textbbox((0, 0), number_text, font=font)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
+    text_width = int(sum(digit_widths[c] for c in number_text))
     text_position = ((width - text_width) // 2, (height - text_height) // 2)
     draw.text(text_position, number_text, font=font, fill=(0, 0, 100))
     
     img_buffer = io.BytesIO()
-    img.save(img_buffer, format="PNG")
+    img.save(img_buffer, format="PNG", compress_level=1)
     img_buffer.seek(0)
     return img_buffer
 
+def generate_user_id():
+    """Gera um UUIDv7 (ordenado pelo tempo) para identificar o usuário."""
+    timestamp_ms = time.time_ns() // 1_000_000
+    raw = bytearray(timestamp_ms.to_bytes(6, "big") + os.urandom(10))
+    raw[6] = (raw[6] & 0x0F) | 0x70  # versão 7
+    raw[8] = (raw[8] & 0x3F) | 0x80  # variante RFC 4122
+    return str(uuid.UUID(bytes=bytes(raw)))
+
 def generate_participant_link(table_name, user_id=None, mode="participant"):
     """Gera um link para participantes acessarem a reunião ou formulário."""
     base_url = "https://mynumber.streamlit.app"
@@ -158,6 +395,119 @@ def generate_participant_link(table_name, user_id=None, mode="participant"):
         return f"{base_url}/?table={table_name}&mode={mode}&user_id={user_id}"
     return f"{base_url}/?table={table_name}&mode={mode}"
 
+@st.fragment
+def number_image_section(number):
+    """Gera a imagem do número sob demanda; o botão reexecuta só este fragmento."""
+    if st.button("Salvar como Imagem"):
+        with st.spinner("Gerando imagem..."):
+            img_buffer = generate_number_image(number)
+            st.image(img_buffer)
+            st.download_button(
+                "Baixar Imagem",
+                img_buffer,
+                file_name=f"meu_numero_{number}.png",
+                mime="image/png"
+            )
+
+@st.fragment
+def meeting_stats_section(supabase, options):
+    """Exibe as estatísticas da reunião selecionada; seus widgets reexecutam só este fragmento."""
+    selected = st.selectbox("Selecione uma reunião:", list(options.keys()))
+
+    if selected:
+        selected_table = options[selected]
+        try:
+            stats = supabase.rpc("get_meeting_stats", {"tab": selected_table}).execute().data
+            total_numbers = stats["total"]
+            assigned_numbers = stats["assigned"]
+            percentage = (assigned_numbers / total_numbers) * 100 if total_numbers > 0 else 0
+
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Total de Números", total_numbers)
+            with col2:
+                st.metric("Números Atribuídos", assigned_numbers)
+            with col3:
+                st.metric("Porcentagem Atribuída", f"{percentage:.1f}%")
+
+            if stats["hourly"]:
+                hourly_counts = pd.DataFrame(stats["hourly"])
+                hourly_counts["hour_str"] = pd.to_datetime(hourly_counts["hour"]).dt.strftime("%m/%d %H:00")
+                st.subheader("Atribuições de Números por Hora")
+                st.bar_chart(data=hourly_counts, x="hour_str", y="count")
+            else:
+                st.info("Dados temporais não disponíveis para esta reunião.")
+
+            if st.button("Exportar Dados"):
+                try:
+                    csv_data = build_meeting_csv(supabase, selected_table, assigned_numbers)
+                    if csv_data:
+                        st.download_button(
+                            "Baixar CSV",
+                            csv_data,
+                            file_name=f"{selected_table}_export.csv",
+                            mime="text/csv"
+                        )
+                except Exception as e:
+                    st.error(f"Erro ao exportar dados: {str(e)}")
+        except Exception as e:
+            st.error(f"Erro ao recuperar estatísticas: {str(e)}")
+
+USER_LINKS_PAGE_SIZE = 50
+
+@st.fragment
+def form_links_section(supabase, options):
+    """Exibe os links do formulário selecionado; a seleção reexecuta só este fragmento."""
+    selected = st.selectbox("Selecione um formulário para compartilhar:", list(options.keys()), key="share_form_select")
+
+    if selected:
+        selected_table = options[selected]
+        participant_link = generate_participant_link(selected_table, mode="participant_form")
+        st.markdown(f"**Link Geral para Participantes:** [{participant_link}]({participant_link})")
+        if st.button("Copiar Link Geral"):
+            st.write("Link copiado para a área de transferência!")
+            st.code(participant_link)
+
+        st.subheader("Links Únicos por Usuário")
+
+        def fetch_user_page(page_number):
+            # A mesma requisição traz a página e o total de usuários
+            offset = (page_number - 1) * USER_LINKS_PAGE_SIZE
+            return (supabase.table("meeting_numbers").select("user_id, number", count="exact")
+                    .eq("assigned", True).order("table_name").order("number")
+                    .range(offset, offset + USER_LINKS_PAGE_SIZE - 1).execute())
+
+        page_number = st.session_state.get("user_links_page", 1)
+        try:
+            assigned_users = fetch_user_page(page_number)
+        except APIError as e:
+            # PGRST103: a página passou do fim (o total diminuiu); volta à primeira para obter o total
+            if e.code != "PGRST103":
+                raise
+            page_number = 1
+            assigned_users = fetch_user_page(page_number)
+        total_users = assigned_users.count or 0
+        if not total_users:
+            st.info("Nenhum usuário com número atribuído encontrado.")
+            return
+
+        total_pages = (total_users + USER_LINKS_PAGE_SIZE - 1) // USER_LINKS_PAGE_SIZE
+        if page_number > total_pages:
+            page_number = total_pages
+            assigned_users = fetch_user_page(page_number)
+        # Ajusta o widget antes de criá-lo, para que o valor nunca passe de max_value
+        st.session_state["user_links_page"] = page_number
+        st.number_input("Página", min_value=1, max_value=total_pages, step=1, key="user_links_page")
+        offset = (page_number - 1) * USER_LINKS_PAGE_SIZE
+        # Colunas montadas diretamente (em vez de um dict por linha)
+        df = pd.DataFrame({
+            "Número": [user["number"] for user in assigned_users.data],
+            "Link": [generate_participant_link(selected_table, user["user_id"], mode="participant_form")
+                     for user in assigned_users.data]
+        })
+        st.dataframe(df, column_config={"Link": st.column_config.LinkColumn("Link")})
+        st.caption(f"Exibindo {offset + 1}–{offset + len(assigned_users.data)} de {total_users} usuários (página {page_number} de {total_pages})")
+
 # --- Verifica Modo (Master, Participant ou Participant_Form) ---
 query_params = st.query_params
 mode = query_params.get("mode", "master")
@@ -168,25 +518,37 @@ if "user_id" not in st.session_state:
     if user_id_from_url:
         st.session_state["user_id"] = user_id_from_url
     else:
-        st.session_state["user_id"] = str(uuid.uuid4())
+        st.session_state["user_id"] = generate_user_id()
+
+# Grava o user_id na URL dos participantes para que recarregar a página ou
+# reconectar mantenha o mesmo usuário (e o mesmo número)
+if mode in ("participant", "participant_form") and table_name_from_url and "user_id" not in query_params:
+    st.query_params["user_id"] = st.session_state["user_id"]
+
+# Conexão única (em cache) compartilhada por todos os modos e páginas
+supabase = get_supabase_client()
+if not supabase:
+    st.stop()
+
+schema_error = prepare_schema(supabase)
+if schema_error:
+    st.error(f"Erro ao preparar o esquema do banco de dados: {schema_error}")
 
 if mode == "participant" and table_name_from_url:
     # --- Modo Participante para Reuniões ---
     st.markdown("<h1 class='main-header'>Obtenha Seu Número</h1>", unsafe_allow_html=True)
-    supabase = get_supabase_client()
-    if not supabase:
-        st.stop()
-    
-    if not check_table_exists(supabase, table_name_from_url):
-        st.error("Reunião não encontrada ou inválida.")
-        st.stop()
-    
+    if "flash_message" in st.session_state:
+        st.toast(st.session_state.pop("flash_message"), icon="✅")
+
+    # A leitura (em cache) dos metadados também confirma que a reunião existe
     try:
-        meeting_info = supabase.table("meetings_metadata").select("*").eq("table_name", table_name_from_url).execute()
-        meeting_name = meeting_info.data[0]["meeting_name"] if meeting_info.data else "Reunião"
-        st.subheader(f"Reunião: {meeting_name}")
+        meeting_info = get_meeting_info(supabase, table_name_from_url)
     except Exception:
-        st.subheader("Obtenha um número para a reunião")
+        meeting_info = None
+    if not meeting_info:
+        st.error("Reunião não encontrada ou inválida.")
+        st.stop()
+    st.subheader(f"Reunião: {meeting_info['meeting_name']}")
 
     user_id = st.session_state["user_id"]
     
@@ -195,28 +557,12 @@ if mode == "participant" and table_name_from_url:
     st.write("Guarde este link para acessar sempre o mesmo número!")
 
     try:
-        existing = supabase.table(table_name_from_url).select("number").eq("user_id", user_id).execute()
-        if existing.data:
-            st.session_state["assigned_number"] = existing.data[0]["number"]
-        else:
-            with st.spinner("Atribuindo um número..."):
-                response = supabase.table(table_name_from_url).select("*").eq("assigned", False).execute()
-                if response.data:
-                    available_numbers = [row["number"] for row in response.data]
-                    if available_numbers:
-                        assigned_number = random.choice(available_numbers)
-                        supabase.table(table_name_from_url).update({
-                            "assigned": True,
-                            "assigned_at": datetime.now().isoformat(),
-                            "user_id": user_id
-                        }).eq("number", assigned_number).execute()
-                        st.session_state["assigned_number"] = assigned_number
-                    else:
-                        st.error("Todos os números foram atribuídos!")
-                        st.stop()
-                else:
-                    st.error("Todos os números foram atribuídos!")
-                    st.stop()
+        with st.spinner("Atribuindo um número..."):
+            response = supabase.rpc("assign_number", {"tab": table_name_from_url, "uid": user_id}).execute()
+        if response.data is None:
+            st.error("Todos os números foram atribuídos!")
+            st.stop()
+        st.session_state["assigned_number"] = response.data
 
         st.markdown(f"""
         <div class='success-msg'>
@@ -243,46 +589,37 @@ if mode == "participant" and table_name_from_url:
         st.error(f"Erro ao atribuir número: {str(e)}")
         st.stop()
     
-    if st.button("Salvar como Imagem"):
-        with st.spinner("Gerando imagem..."):
-            img_buffer = generate_number_image(st.session_state["assigned_number"])
-            st.image(img_buffer)
-            st.download_button(
-                "Baixar Imagem",
-                img_buffer,
-                file_name=f"meu_numero_{st.session_state['assigned_number']}.png",
-                mime="image/png"
-            )
+    number_image_section(st.session_state["assigned_number"])
 
 elif mode == "participant_form" and table_name_from_url:
     # --- Modo Participante para Formulários ---
     st.markdown("<h1 class='main-header'>Responder Formulário</h1>", unsafe_allow_html=True)
-    supabase = get_supabase_client()
-    if not supabase:
-        st.stop()
-    
-    form_info = supabase.table("forms_metadata").select("*").eq("table_name", table_name_from_url).execute()
-    if not form_info.data:
+    user_id = st.session_state["user_id"]
+    # O número do usuário não depende do formulário: busca em paralelo à leitura do formulário
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assigned_future = executor.submit(
+            lambda: supabase.table("meeting_numbers").select("table_name, number").eq("user_id", user_id).limit(1).execute()
+        )
+        form_info = get_form_with_questions(supabase, table_name_from_url)
+        assigned = assigned_future.result()
+
+    if not form_info:
         st.error("Formulário não encontrado.")
         st.stop()
 
-    form_id = form_info.data[0]['id']
-    st.subheader(f"Formulário: {form_info.data[0]['form_name']}")
+    form_id = form_info['id']
+    st.subheader(f"Formulário: {form_info['form_name']}")
 
-    questions = supabase.table("questions").select("*").eq("form_id", form_id).execute()
-    if not questions.data:
+    questions = form_info['questions']
+    if not questions:
         st.error("Nenhuma pergunta encontrada para este formulário.")
         st.stop()
 
-    user_id = st.session_state["user_id"]
     participant_id_default = ""
     meeting_table_name = ""
-    for meeting in get_available_meetings(supabase):
-        assigned = supabase.table(meeting["table_name"]).select("number").eq("user_id", user_id).execute()
-        if assigned.data:
-            participant_id_default = str(assigned.data[0]["number"])
-            meeting_table_name = meeting["table_name"]
-            break
+    if assigned.data:
+        participant_id_default = str(assigned.data[0]["number"])
+        meeting_table_name = assigned.data[0]["table_name"]
     
     if not participant_id_default:
         st.error("Você precisa ter um número atribuído para responder formulários.")
@@ -290,38 +627,39 @@ elif mode == "participant_form" and table_name_from_url:
 
     # Verificar se o formulário já foi respondido
     participant_id = participant_id_default
-    answered_forms = get_answered_forms(supabase, participant_id)
-    if form_id in answered_forms:
+    if has_answered_form(supabase, participant_id, form_id):
         st.warning("Você já respondeu este formulário. Cada participante só pode responder uma vez.")
         st.stop()
 
     with st.form("form_submission"):
         responses = {}
-        for q in questions.data:
+        for q in questions:
             st.write(f"{q['question_text']}")
             if q['question_type'] == 'text':
                 responses[q['id']] = st.text_input("Sua resposta", key=f"resp_{q['id']}")
             elif q['question_type'] == 'multiple_choice':
-                options = supabase.table("options").select("*").eq("question_id", q['id']).execute()
-                option_texts = [opt['option_text'] for opt in options.data]
-                option_ids = [opt['id'] for opt in options.data]
+                option_texts = [opt['option_text'] for opt in q['options']]
+                option_ids = [opt['id'] for opt in q['options']]
                 selected_option = st.selectbox("Escolha uma opção", option_texts, key=f"resp_{q['id']}")
                 responses[q['id']] = option_ids[option_texts.index(selected_option)]
 
         st.text_input("Seu Nome ou ID", value=participant_id, key="participant_id", disabled=True)
         if st.form_submit_button("Enviar"):
             if all(responses.values()):
-                for q_id, answer in responses.items():
-                    response_data = {
-                        "form_id": form_id,
-                        "participant_id": participant_id,
-                        "question_id": q_id,
-                        "answer": str(answer)
-                    }
-                    supabase.table("responses").insert(response_data).execute()
-                st.success("Respostas enviadas com sucesso!")
-                st.markdown(f"Voltando para sua página de participante em 3 segundos...")
-                time.sleep(3)
+                responses_data = [{
+                    "form_id": form_id,
+                    "participant_id": participant_id,
+                    "question_id": q_id,
+                    "answer": str(answer)
+                } for q_id, answer in responses.items()]
+                try:
+                    supabase.table("responses").insert(responses_data).execute()
+                except Exception as e:
+                    # Inclui a violação do índice único em um envio duplicado
+                    st.error(f"Erro ao enviar respostas: {str(e)}")
+                    st.stop()
+                # Exibido como toast na página de participante, logo após o rerun
+                st.session_state["flash_message"] = "Respostas enviadas com sucesso!"
                 st.query_params.update({
                     "table": meeting_table_name,
                     "mode": "participant",
@@ -340,14 +678,13 @@ else:
     st.sidebar.title("Menu (Master)")
     page = st.sidebar.radio("Escolha uma opção", valid_pages, index=valid_pages.index(st.session_state["page"]))
 
+    if "flash_message" in st.session_state:
+        st.success(st.session_state.pop("flash_message"))
+
     # --- Página 1: Gerenciar Reuniões ---
     if page == "Gerenciar Reuniões":
         st.session_state["page"] = "Gerenciar Reuniões"
         st.markdown("<h1 class='main-header'>Gerenciar Reuniões</h1>", unsafe_allow_html=True)
-        supabase = get_supabase_client()
-        if not supabase:
-            st.stop()
-        
         with st.form("create_meeting_form"):
             st.subheader("Criar Nova Reunião")
             meeting_name = st.text_input("Nome da Reunião")
@@ -356,16 +693,16 @@ else:
             
             if submit_button:
                 if meeting_name:
-                    table_name = f"meeting_{int(time.time())}_{meeting_name.lower().replace(' ', '_')}"
-                    if check_table_exists(supabase, table_name):
+                    table_name = build_table_name("meeting", meeting_name)
+                    if meeting_exists(supabase, table_name):
                         st.error("Uma reunião com esse nome já existe. Tente outro nome.")
                     else:
                         with st.spinner("Criando reunião..."):
-                            success = create_meeting_table(supabase, table_name, meeting_name, max_number)
+                            success = create_meeting(supabase, table_name, meeting_name, max_number)
                             if success:
-                                participant_link = generate_participant_link(table_name, mode="participant")
-                                st.success(f"Reunião '{meeting_name}' criada com sucesso!")
-                                st.markdown(f"**Link para Participantes:** [{participant_link}]({participant_link})")
+                                get_available_meetings.clear()
+                                # A página de compartilhamento exibe a mensagem e já abre nesta reunião
+                                st.session_state["flash_message"] = f"Reunião '{meeting_name}' criada com sucesso!"
                                 st.session_state["selected_table"] = table_name
                                 st.session_state["page"] = "Compartilhar Link da Reunião"
                                 st.rerun()
@@ -381,21 +718,20 @@ else:
             for meeting in meetings:
                 if "table_name" in meeting and "meeting_name" in meeting:
                     table_name = meeting["table_name"]
-                    if check_table_exists(supabase, table_name):
-                        try:
-                            count_response = supabase.table(table_name).select("*", count="exact").eq("assigned", True).execute()
-                            assigned_count = count_response.count if hasattr(count_response, 'count') else 0
-                            participant_link = generate_participant_link(table_name, mode="participant")
-                            meeting_data.append({
-                                "Nome": meeting.get("meeting_name", "Sem nome"),
-                                "Tabela": table_name,
-                                "Link": participant_link,
-                                "Criada em": meeting.get("created_at", "")[:16].replace("T", " "),
-                                "Números Atribuídos": assigned_count,
-                                "Total de Números": meeting.get("max_number", 0)
-                            })
-                        except Exception as e:
-                            st.warning(f"Erro ao processar reunião {table_name}: {str(e)}")
+                    try:
+                        count_response = supabase.table("meeting_numbers").select("number", count="exact", head=True).eq("table_name", table_name).eq("assigned", True).execute()
+                        assigned_count = count_response.count if hasattr(count_response, 'count') else 0
+                        participant_link = generate_participant_link(table_name, mode="participant")
+                        meeting_data.append({
+                            "Nome": meeting.get("meeting_name", "Sem nome"),
+                            "Tabela": table_name,
+                            "Link": participant_link,
+                            "Criada em": meeting.get("created_at", "")[:16].replace("T", " "),
+                            "Números Atribuídos": assigned_count,
+                            "Total de Números": meeting.get("max_number", 0)
+                        })
+                    except Exception as e:
+                        st.warning(f"Erro ao processar reunião {table_name}: {str(e)}")
             if meeting_data:
                 df = pd.DataFrame(meeting_data)
                 st.dataframe(df)
@@ -409,10 +745,6 @@ else:
         st.session_state["page"] = "Compartilhar Link da Reunião"
         st.markdown("<h1 class='main-header'>Compartilhar Link da Reunião</h1>", unsafe_allow_html=True)
         
-        supabase = get_supabase_client()
-        if not supabase:
-            st.stop()
-        
         meetings = get_available_meetings(supabase)
         if not meetings:
             st.info("Nenhuma reunião disponível. Crie uma reunião primeiro.")
@@ -420,7 +752,12 @@ else:
         
         options = {f"{m['meeting_name']} ({m['table_name']})": m["table_name"] 
                    for m in meetings if "table_name" in m and "meeting_name" in m}
-        selected = st.selectbox("Selecione uma reunião para compartilhar:", list(options.keys()))
+        # Reunião recém-criada: pré-seleciona sua opção
+        created_table = st.session_state.pop("selected_table", None)
+        for label, table in options.items():
+            if table == created_table:
+                st.session_state["share_meeting_select"] = label
+        selected = st.selectbox("Selecione uma reunião para compartilhar:", list(options.keys()), key="share_meeting_select")
         
         if selected:
             selected_table = options[selected]
@@ -434,10 +771,6 @@ else:
     elif page == "Ver Estatísticas":
         st.session_state["page"] = "Ver Estatísticas"
         st.markdown("<h1 class='main-header'>Estatísticas da Reunião</h1>", unsafe_allow_html=True)
-        supabase = get_supabase_client()
-        if not supabase:
-            st.stop()
-        
         meetings = get_available_meetings(supabase)
         if not meetings:
             st.info("Nenhuma reunião disponível para análise.")
@@ -445,71 +778,12 @@ else:
         
         options = {f"{m['meeting_name']} ({m['table_name']})": m["table_name"] 
                    for m in meetings if "table_name" in m and "meeting_name" in m}
-        selected = st.selectbox("Selecione uma reunião:", list(options.keys()))
-        
-        if selected:
-            selected_table = options[selected]
-            try:
-                total_response = supabase.table(selected_table).select("*", count="exact").execute()
-                total_numbers = total_response.count if hasattr(total_response, 'count') else 0
-                assigned_response = supabase.table(selected_table).select("*", count="exact").eq("assigned", True).execute()
-                assigned_numbers = assigned_response.count if hasattr(assigned_response, 'count') else 0
-                percentage = (assigned_numbers / total_numbers) * 100 if total_numbers > 0 else 0
-                
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("Total de Números", total_numbers)
-                with col2:
-                    st.metric("Números Atribuídos", assigned_numbers)
-                with col3:
-                    st.metric("Porcentagem Atribuída", f"{percentage:.1f}%")
-                
-                try:
-                    time_data_response = supabase.table(selected_table).select("*").eq("assigned", True).order("assigned_at").execute()
-                    if time_data_response.data:
-                        time_data = []
-                        for item in time_data_response.data:
-                            if item.get("assigned_at"):
-                                time_data.append({
-                                    "time": item.get("assigned_at")[:16].replace("T", " "),
-                                    "count": 1
-                                })
-                        if time_data:
-                            df = pd.DataFrame(time_data)
-                            df["time"] = pd.to_datetime(df["time"])
-                            df["hour"] = df["time"].dt.floor("H")
-                            hourly_counts = df.groupby("hour").count().reset_index()
-                            hourly_counts["hour_str"] = hourly_counts["hour"].dt.strftime("%m/%d %H:00")
-                            st.subheader("Atribuições de Números por Hora")
-                            st.bar_chart(data=hourly_counts, x="hour_str", y="count")
-                except Exception:
-                    st.info("Dados temporais não disponíveis para esta reunião.")
-                
-                if st.button("Exportar Dados"):
-                    try:
-                        all_data_response = supabase.table(selected_table).select("*").execute()
-                        if all_data_response.data:
-                            df = pd.DataFrame(all_data_response.data)
-                            csv = df.to_csv(index=False)
-                            st.download_button(
-                                "Baixar CSV",
-                                csv,
-                                file_name=f"{selected_table}_export.csv",
-                                mime="text/csv"
-                            )
-                    except Exception as e:
-                        st.error(f"Erro ao exportar dados: {str(e)}")
-            except Exception as e:
-                st.error(f"Erro ao recuperar estatísticas: {str(e)}")
+        meeting_stats_section(supabase, options)
 
     # --- Página 4: Gerenciar Formulários ---
     elif page == "Gerenciar Formulários":
         st.session_state["page"] = "Gerenciar Formulários"
         st.markdown("<h1 class='main-header'>Gerenciar Formulários</h1>", unsafe_allow_html=True)
-        supabase = get_supabase_client()
-        if not supabase:
-            st.stop()
-        
         with st.form("create_form_form"):
             st.subheader("Criar Novo Formulário")
             form_name = st.text_input("Nome do Formulário", key="form_name")
@@ -569,31 +843,40 @@ else:
 
             if st.form_submit_button("Criar Formulário"):
                 if form_name and st.session_state['questions']:
-                    table_name = f"form_{int(time.time())}_{form_name.lower().replace(' ', '_')}"
+                    table_name = build_table_name("form", form_name)
                     form_data = {"form_name": form_name, "table_name": table_name, "created_at": datetime.now().isoformat()}
                     form_response = supabase.table("forms_metadata").insert(form_data).execute()
                     form_id = form_response.data[0]['id']
 
-                    for q in st.session_state['questions']:
-                        question_data = {
-                            "form_id": form_id,
-                            "question_text": q['text'],
-                            "question_type": q['type'],
-                            "correct_answer": q['correct']
-                        }
-                        q_response = supabase.table("questions").insert(question_data).execute()
-                        question_id = q_response.data[0]['id']
-
+                    questions_data = [{
+                        "form_id": form_id,
+                        "question_text": q['text'],
+                        "question_type": q['type'],
+                        "correct_answer": q['correct']
+                    } for q in st.session_state['questions']]
+                    q_response = supabase.table("questions").insert(questions_data).execute()
+
+                    questions_by_id = {}
+                    options_data = []
+                    for q, q_row in zip(st.session_state['questions'], q_response.data):
+                        questions_by_id[q_row['id']] = (q, q_row)
                         if q['type'] == 'multiple_choice':
-                            for opt in q['options']:
-                                opt_data = {"question_id": question_id, "option_text": opt}
-                                opt_response = supabase.table("options").insert(opt_data).execute()
-                                if opt == q['correct']:
-                                    supabase.table("questions").update({"correct_answer": str(opt_response.data[0]['id'])}).eq("id", question_id).execute()
-
-                    participant_link = generate_participant_link(table_name, mode="participant_form")
-                    st.success(f"Formulário '{form_name}' criado com sucesso!")
-                    st.markdown(f"**Link Geral para Participantes:** [{participant_link}]({participant_link})")
+                            options_data.extend({"question_id": q_row['id'], "option_text": opt} for opt in q['options'])
+
+                    if options_data:
+                        opt_response = supabase.table("options").insert(options_data).execute()
+                        # A resposta correta de múltipla escolha é o id da opção criada
+                        correct_option_ids = {}
+                        for opt_row in opt_response.data:
+                            q, q_row = questions_by_id[opt_row['question_id']]
+                            if opt_row['option_text'] == q['correct']:
+                                correct_option_ids[q_row['id']] = opt_row['id']
+                        for question_id, option_id in correct_option_ids.items():
+                            supabase.table("questions").update({"correct_answer": str(option_id)}).eq("id", question_id).execute()
+
+                    get_available_forms.clear()
+                    # A página de compartilhamento exibe a mensagem e já abre neste formulário
+                    st.session_state["flash_message"] = f"Formulário '{form_name}' criado com sucesso!"
                     st.session_state['questions'] = []
                     st.session_state["selected_form_table"] = table_name
                     st.session_state["page"] = "Compartilhar Link do Formulário"
@@ -622,10 +905,6 @@ else:
         st.session_state["page"] = "Compartilhar Link do Formulário"
         st.markdown("<h1 class='main-header'>Compartilhar Link do Formulário</h1>", unsafe_allow_html=True)
         
-        supabase = get_supabase_client()
-        if not supabase:
-            st.stop()
-        
         forms = get_available_forms(supabase)
         if not forms:
             st.info("Nenhum formulário disponível. Crie um formulário primeiro.")
@@ -633,29 +912,12 @@ else:
         
         options = {f"{f['form_name']} ({f['table_name']})": f["table_name"] 
                    for f in forms if "table_name" in f and "form_name" in f}
-        selected = st.selectbox("Selecione um formulário para compartilhar:", list(options.keys()))
-        
-        if selected:
-            selected_table = options[selected]
-            participant_link = generate_participant_link(selected_table, mode="participant_form")
-            st.markdown(f"**Link Geral para Participantes:** [{participant_link}]({participant_link})")
-            if st.button("Copiar Link Geral"):
-                st.write("Link copiado para a área de transferência!")
-                st.code(participant_link)
-
-            st.subheader("Links Únicos por Usuário")
-            meetings = get_available_meetings(supabase)
-            user_links = []
-            for meeting in meetings:
-                assigned_users = supabase.table(meeting["table_name"]).select("user_id, number").eq("assigned", True).execute()
-                for user in assigned_users.data:
-                    user_link = generate_participant_link(selected_table, user["user_id"], mode="participant_form")
-                    user_links.append({"Número": user["number"], "Link": user_link})
-            if user_links:
-                df = pd.DataFrame(user_links)
-                st.dataframe(df, column_config={"Link": st.column_config.LinkColumn("Link")})
-            else:
-                st.info("Nenhum usuário com número atribuído encontrado.")
+        # Formulário recém-criado: pré-seleciona sua opção
+        created_table = st.session_state.pop("selected_form_table", None)
+        for label, table in options.items():
+            if table == created_table:
+                st.session_state["share_form_select"] = label
+        form_links_section(supabase, options)
 
 if __name__ == "__main__":
     pass